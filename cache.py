@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import logging
+import os
+from array import array
+from typing import List
+
+import redis
+import redis.asyncio
+from redis.commands.search.field import TagField, VectorField
+from redis.commands.search.index_definition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+from models import BatchedScoreResponse, Submission
+
+CACHE_TTL_SECONDS = 60 * 60 * 24 * 30
+SIMILARITY_THRESHOLD = 0.98
+# A semantic hit reuses another student's score and feedback, so it is opt-in.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE", "0") == "1"
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+# text-embedding-3-small accepts 8191 tokens; longer submissions only use the exact tier.
+MAX_EMBEDDING_CHARS = 24000
+
+_EXACT_PREFIX = "score_cache:exact:"
+_VECTOR_PREFIX = "score_cache:vector:"
+_INDEX_NAME = "score_cache_idx"
+
+redis_client = redis.asyncio.Redis.from_url("redis://localhost:6379/1")
+logger = logging.getLogger(__name__)
+
+_semantic_available: bool | None = None
+_index_lock = asyncio.Lock()
+
+
+def cache_scope(
+    model: str, prompt_version: int, criteria_json: str, assignment_description: str
+) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(model.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(str(prompt_version).encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(criteria_json.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(assignment_description.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def submission_text(submission: Submission) -> str:
+    return "".join(sorted(file.content for file in submission.files))
+
+
+def submission_digest(submission: Submission) -> str:
+    # Identifies a submission by its files alone; shared by the score cache and
+    # the dedup of identical submissions within a run.
+    hasher = hashlib.sha256()
+    # Length-prefix each name and content so different splits of the same text
+    # (["ab", "c"] vs ["a", "bc"]) can't produce the same digest.
+    for file in sorted(
+        submission.files, key=lambda f: (f.name, f.content, f.note or "")
+    ):
+        for part in (
+            file.name.encode("utf-8"),
+            file.content.encode("utf-8"),
+            (file.note or "").encode("utf-8"),
+        ):
+            hasher.update(f"{len(part)}:".encode("ascii"))
+            hasher.update(part)
+    return hasher.hexdigest()
+
+
+def cache_key(scope: str, submission: Submission) -> str:
+    return hashlib.sha256(
+        f"{scope}\0{submission_digest(submission)}".encode("ascii")
+    ).hexdigest()
+
+
+async def get_exact(key: str) -> BatchedScoreResponse | None:
+    try:
+        cached = await redis_client.get(_EXACT_PREFIX + key)
+    except redis.RedisError as e:
+        logger.warning(f"Score cache unavailable: {e}")
+        return None
+
+    if cached is None:
+        return None
+
+    return BatchedScoreResponse.model_validate_json(cached)
+
+
+async def get_similar(
+    scope: str, embedding: List[float], submission_name: str
+) -> BatchedScoreResponse | None:
+    if not await semantic_enabled():
+        return None
+
+    query = (
+        Query(f"(@scope:{{{scope}}})=>[KNN 1 @embedding $vec AS distance]")
+        .return_fields("distance", "response")
+        .dialect(2)
+    )
+
+    try:
+        result = await redis_client.ft(_INDEX_NAME).search(
+            query, query_params={"vec": _to_bytes(embedding)}
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Semantic score cache unavailable: {e}")
+        return None
+
+    if not result.docs:
+        return None
+
+    best = result.docs[0]
+    # COSINE distance in RediSearch is 1 - cosine similarity.
+    similarity = 1 - float(best.distance)
+    if similarity <= SIMILARITY_THRESHOLD:
+        return None
+
+    logger.info(
+        f"{submission_name}: similar to cached submission {best.id} "
+        f"(similarity {similarity:.3f}), reusing its score"
+    )
+    return BatchedScoreResponse.model_validate_json(best.response)
+
+
+async def store(
+    key: str,
+    scope: str,
+    response: BatchedScoreResponse,
+    embedding: List[float] | None = None,
+) -> None:
+    payload = response.model_dump_json()
+
+    try:
+        await redis_client.setex(_EXACT_PREFIX + key, CACHE_TTL_SECONDS, payload)
+
+        if embedding is not None and await semantic_enabled():
+            vector_key = _VECTOR_PREFIX + key
+            pipeline = redis_client.pipeline()
+            pipeline.hset(
+                vector_key,
+                mapping={
+                    "scope": scope,
+                    "embedding": _to_bytes(embedding),
+                    "response": payload,
+                },
+            )
+            pipeline.expire(vector_key, CACHE_TTL_SECONDS)
+            await pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not write to score cache: {e}")
+
+
+async def semantic_enabled() -> bool:
+    return SEMANTIC_CACHE_ENABLED and await _ensure_index()
+
+
+async def _ensure_index() -> bool:
+    global _semantic_available
+
+    async with _index_lock:
+        if _semantic_available is not None:
+            return _semantic_available
+
+        index = redis_client.ft(_INDEX_NAME)
+        try:
+            await index.info()
+            _semantic_available = True
+        except redis.ResponseError:
+            try:
+                await index.create_index(
+                    [
+                        TagField("scope"),
+                        VectorField(
+                            "embedding",
+                            "HNSW",
+                            {
+                                "TYPE": "FLOAT32",
+                                "DIM": EMBEDDING_DIMENSIONS,
+                                "DISTANCE_METRIC": "COSINE",
+                            },
+                        ),
+                    ],
+                    definition=IndexDefinition(
+                        prefix=[_VECTOR_PREFIX], index_type=IndexType.HASH
+                    ),
+                )
+                _semantic_available = True
+            except redis.ResponseError as e:
+                # Plain Redis without the search module; keep the exact tier only.
+                logger.warning(f"Semantic score cache disabled: {e}")
+                _semantic_available = False
+        except redis.RedisError as e:
+            logger.warning(f"Semantic score cache unavailable: {e}")
+            return False
+
+        return _semantic_available
+
+
+def _to_bytes(embedding: List[float]) -> bytes:
+    return array("f", embedding).tobytes()
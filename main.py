@@ -1,83 +1,86 @@
+import asyncio
 import csv
 import logging
+import os
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from contextlib import closing
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from queue import Queue
+from typing import Any, Deque, Dict, List, TextIO, Tuple
 
 import typer
-from rich.progress import (BarColumn, MofNCompleteColumn, Progress,
+from openai.types import Batch
+from rich.progress import (BarColumn, MofNCompleteColumn, Progress, TaskID,
                            TaskProgressColumn, TextColumn, TimeElapsedColumn,
                            TimeRemainingColumn)
 
-from models import CriteriaScore, Status, Submission, SubmissionScore
+from cache import submission_digest
+from models import BatchedScoreResponse, Status, Submission, SubmissionScore
 from rubric import Rubric, load_rubric, print_rubric
 from submission import get_submissions
-from tasks import prepare_submission, score_submission_batched
+from tasks import (build_score_result, dump_criteria, prepare_submission,
+                   prime_prefix, score_batch, score_with_batch_api)
 from utils import (configure_rich_progress_logging, extract_name,
                    format_decimal, print_error)
 
 CSV_FIELDNAMES = ["Name", "Criteria", "Level", "Score", "Feedback"]
 
+CSVRow = Tuple[str, str, str, str, str]
 
-def initialize_csv(output_path: Path = Path("scores.csv")) -> None:
-    with open(output_path, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
-        writer.writeheader()
+CSV_FLUSH_EVERY = 10
+
+SMALL_SUBMISSION_CHARS = 8000
+
+
+def submission_rows(submission: Submission) -> List[CSVRow]:
+    if submission.score is None:
+        status_info = "Failed" if submission.status == Status.FAILED else "No Score"
+        return [(submission.name, "", "", "", status_info)]
+
+    rows: List[CSVRow] = [
+        (
+            submission.name,
+            criteria_score.criteria_name,
+            criteria_score.level_definition,
+            format_decimal(criteria_score.score),
+            criteria_score.feedback or "",
+        )
+        for criteria_score in submission.score.criteria_scores
+    ]
+
+    if submission.score.overall_feedback:
+        rows.append((submission.name, "", "", "", submission.score.overall_feedback))
+
+    return rows
 
 
 def append_submission_to_csv(
-    submission: Submission,
-    output_path: Path = Path("scores.csv"),
-    csv_lock: threading.Lock | None = None,
+    submission: Submission, csv_queue: "Queue[Submission | None]"
 ) -> None:
-    if csv_lock:
-        csv_lock.acquire()
+    csv_queue.put(submission)
 
-    try:
-        with open(output_path, "a", newline="", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
 
-            if submission.score is None:
-                status_info = (
-                    "Failed" if submission.status == Status.FAILED else "No Score"
-                )
-                writer.writerow(
-                    {
-                        "Name": submission.name,
-                        "Criteria": "",
-                        "Level": "",
-                        "Score": "",
-                        "Feedback": status_info,
-                    }
-                )
-                return
-
-            for criteria_score in submission.score.criteria_scores:
-                writer.writerow(
-                    {
-                        "Name": submission.name,
-                        "Criteria": criteria_score.criteria_name,
-                        "Level": criteria_score.level_definition,
-                        "Score": format_decimal(criteria_score.score),
-                        "Feedback": criteria_score.feedback,
-                    }
-                )
+def _writer_loop(
+    csv_queue: "Queue[Submission | None]",
+    writer: Any,
+    csv_file: TextIO,
+    flush_every: int = CSV_FLUSH_EVERY,
+) -> None:
+    written = 0
+    while True:
+        submission = csv_queue.get()
+        if submission is None:
+            break
 
-            if submission.score.overall_feedback:
-                writer.writerow(
-                    {
-                        "Name": submission.name,
-                        "Criteria": "",
-                        "Level": "",
-                        "Score": "",
-                        "Feedback": submission.score.overall_feedback,
-                    }
-                )
-    finally:
-        if csv_lock:
-            csv_lock.release()
+        writer.writerows(submission_rows(submission))
+        written += 1
+        if written % flush_every == 0:
+            csv_file.flush()
+
+    csv_file.flush()
+    os.fsync(csv_file.fileno())
 
 
 def validate_paths(
@@ -127,77 +130,255 @@ def create_failed_submission(
     )
 
 
-def process_single_submission(
-    submission_folder: str,
+def apply_score(
+    submission: Submission, score: SubmissionScore, logger: logging.Logger
+) -> None:
+    if not score.criteria_scores:
+        return
+
+    submission.score = score
+    if submission.status != Status.EMPTY:
+        submission.status = Status.SCORED
+
+    logger.info(f"{submission.name}: {format_decimal(score.total_score)} points")
+
+    for criteria_score in score.criteria_scores:
+        logger.info(
+            f"* {criteria_score.criteria_name}: "
+            f"{format_decimal(criteria_score.score)} points"
+        )
+        logger.info(f"  * {criteria_score.level_definition}")
+        if criteria_score.feedback:
+            logger.info(f"  * Feedback: {criteria_score.feedback}")
+
+    if score.overall_feedback:
+        logger.info(f"* Overall Feedback: {score.overall_feedback}")
+
+
+class GroupSizer:
+    """Adapts how many small submissions share one LLM call.
+
+    The group doubles while calls finish faster than min_seconds and halves
+    once they take longer than max_seconds, using a smoothed call duration.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        min_seconds: float = 10.0,
+        max_seconds: float = 60.0,
+        smoothing: float = 0.3,
+    ):
+        self.size = 1
+        self.max_size = max_size
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.smoothing = smoothing
+        self._mean_seconds: float | None = None
+
+    def record(self, group_size: int, elapsed: float) -> None:
+        # Calls made with an older or partially cached group say nothing about
+        # the current size.
+        if group_size != self.size:
+            return
+
+        if self._mean_seconds is None:
+            self._mean_seconds = elapsed
+        else:
+            self._mean_seconds = (
+                self.smoothing * elapsed + (1 - self.smoothing) * self._mean_seconds
+            )
+
+        if self._mean_seconds < self.min_seconds and self.size < self.max_size:
+            self.size = min(self.size * 2, self.max_size)
+            self._mean_seconds = None
+        elif self._mean_seconds > self.max_seconds and self.size > 1:
+            self.size = max(self.size // 2, 1)
+            self._mean_seconds = None
+
+
+def is_small_submission(submission: Submission) -> bool:
+    return sum(len(file.content) for file in submission.files) <= SMALL_SUBMISSION_CHARS
+
+
+async def process_submissions(
+    submission_folders: List[str],
     rubric: Rubric,
     assignment_description_content: str,
-    csv_output_path: Path,
+    csv_queue: "Queue[Submission | None]",
     logger: logging.Logger,
-    csv_lock: threading.Lock,
-) -> Submission:
-    submission_name = Path(submission_folder).name
-    submission = None
-    submission_dict = None
-    criteria_scores = None
+    progress: Progress,
+    task: TaskID,
+    concurrency: int,
+    max_group_size: int,
+    prefix_run_id: str | None = None,
+) -> List[Submission]:
+    all_submissions: List[Submission] = []
+    sizer = GroupSizer(max_group_size)
+    criteria_json = dump_criteria(rubric.criteria)
 
-    try:
+    if prefix_run_id:
         try:
-            prepare_result = prepare_submission.delay(submission_folder)
-            submission_dict = prepare_result.get()
-            submission = Submission.model_validate(submission_dict)
+            prefix_id = await prime_prefix(
+                rubric.criteria, assignment_description_content, prefix_run_id
+            )
+            logger.info(f"Stored shared prompt prefix as {prefix_id}")
         except Exception as e:
-            logger.error(e)
-            raise
+            logger.warning(f"Could not store shared prompt prefix: {e}")
+
+    def record(submission: Submission) -> None:
+        all_submissions.append(submission)
+        append_submission_to_csv(submission, csv_queue)
+        progress.update(task, advance=1)
+
+    prepared = await asyncio.gather(
+        *(
+            asyncio.to_thread(prepare_submission, submission_folder)
+            for submission_folder in submission_folders
+        ),
+        return_exceptions=True,
+    )
+
+    loop = asyncio.get_running_loop()
+    # A None result means scoring the first submission with that content failed.
+    results_by_hash: Dict[str, asyncio.Future[SubmissionScore | None]] = {}
+    duplicates: List[Tuple[Submission, str]] = []
+
+    queue: Deque[Tuple[Submission, str]] = deque()
+    for submission_folder, result in zip(submission_folders, prepared):
+        if isinstance(result, Exception):
+            logger.error(result)
+            record(
+                create_failed_submission(
+                    submission_folder, Path(submission_folder).name
+                )
+            )
+            continue
+
+        content_hash = submission_digest(result)
+        if content_hash in results_by_hash:
+            duplicates.append((result, content_hash))
+        else:
+            results_by_hash[content_hash] = loop.create_future()
+            queue.append((result, content_hash))
+
+    async def worker() -> None:
+        while queue:
+            group = [queue.popleft()]
+            small = is_small_submission(group[0][0])
+            if small:
+                while (
+                    queue
+                    and len(group) < sizer.size
+                    and is_small_submission(queue[0][0])
+                ):
+                    group.append(queue.popleft())
 
-        if submission:
             try:
-                criteria_dicts = [criteria.model_dump() for criteria in rubric.criteria]
-                batched_scoring_task = score_submission_batched.delay(
-                    criteria_dicts,
+                scores = await score_batch(
+                    rubric.criteria,
+                    criteria_json,
                     assignment_description_content,
-                    submission_dict,
+                    [submission for submission, _ in group],
+                    sizer.record if small else None,
                 )
-                batched_result = batched_scoring_task.get()
-
-                criteria_scores = [
-                    CriteriaScore.model_validate(score_dict)
-                    for score_dict in batched_result["criteria_scores"]
-                ]
-                overall_feedback = batched_result["overall_feedback"]
-
             except Exception as e:
                 logger.error(e)
-                submission.status = Status.FAILED
-                return submission
+                for submission, content_hash in group:
+                    submission.status = Status.FAILED
+                    results_by_hash[content_hash].set_result(None)
+                    record(submission)
+                continue
+
+            for (submission, content_hash), score in zip(group, scores):
+                apply_score(submission, score, logger)
+                results_by_hash[content_hash].set_result(score)
+                record(submission)
+
+    async def reuse_score(submission: Submission, content_hash: str) -> None:
+        score = await results_by_hash[content_hash]
+        logger.info(
+            f"{submission.name}: same files as an earlier submission, "
+            "reusing its score"
+        )
+        if score is None:
+            submission.status = Status.FAILED
+        else:
+            apply_score(submission, score.model_copy(deep=True), logger)
+        record(submission)
 
-            if criteria_scores:
-                total_score = sum(score.score for score in criteria_scores)
+    async def score_all() -> None:
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            for result in results_by_hash.values():
+                if not result.done():
+                    result.set_result(None)
+
+    await asyncio.gather(
+        score_all(),
+        *(
+            reuse_score(submission, content_hash)
+            for submission, content_hash in duplicates
+        ),
+    )
 
-                submission.score = SubmissionScore(
-                    total_score=total_score,
-                    criteria_scores=criteria_scores,
-                    overall_feedback=overall_feedback,
-                )
-                submission.status = Status.SCORED
+    return all_submissions
 
-                logger.info(f"{submission.name}: {format_decimal(total_score)} points")
 
-                for score in criteria_scores:
-                    logger.info(
-                        f"* {score.criteria_name}: {format_decimal(score.score)} points"
-                    )
-                    logger.info(f"  * {score.level_definition}")
-                    if score.feedback:
-                        logger.info(f"  * Feedback: {score.feedback}")
+async def process_batch(
+    submission_folders: List[str],
+    rubric: Rubric,
+    assignment_description_content: str,
+    batch_file_path: Path,
+    csv_queue: "Queue[Submission | None]",
+    logger: logging.Logger,
+    progress: Progress,
+    task: TaskID,
+) -> List[Submission]:
+    all_submissions: List[Submission] = []
+    prepared: List[Submission] = []
 
-                if overall_feedback:
-                    logger.info(f"* Overall Feedback: {overall_feedback}")
+    for submission_folder in submission_folders:
+        submission_name = Path(submission_folder).name
+        try:
+            prepared.append(prepare_submission(submission_folder))
+        except Exception as e:
+            logger.error(f"Error processing {submission_name}: {e}")
+            failed_submission = create_failed_submission(
+                submission_folder, submission_name
+            )
+            all_submissions.append(failed_submission)
+            append_submission_to_csv(failed_submission, csv_queue)
+            progress.update(task, advance=1)
+
+    if not prepared:
+        return all_submissions
+
+    def on_status(batch: Batch) -> None:
+        progress.update(task, description=f"Scoring Submissions (batch {batch.status})")
+
+    results = await score_with_batch_api(
+        rubric.criteria,
+        dump_criteria(rubric.criteria),
+        assignment_description_content,
+        prepared,
+        batch_file_path,
+        on_status,
+    )
 
-        return submission
+    for submission, result in zip(prepared, results):
+        if isinstance(result, BatchedScoreResponse):
+            apply_score(submission, build_score_result(rubric.criteria, result), logger)
+        else:
+            logger.error(f"Error processing {submission.name}: {result}")
+            submission.status = Status.FAILED
 
-    except Exception as e:
-        logger.error(e)
-        return create_failed_submission(submission_folder, submission_name)
+        all_submissions.append(submission)
+        append_submission_to_csv(submission, csv_queue)
+        progress.update(task, advance=1)
+
+    return all_submissions
 
 
 def main(
@@ -208,6 +389,25 @@ def main(
     submissions_folder: Path = typer.Argument(
         ..., help="Path to the folder containing submissions"
     ),
+    batch: bool = typer.Option(
+        False,
+        "--batch",
+        help="Score all submissions in one OpenAI Batch API job (cheaper, slower)",
+    ),
+    concurrency: int = typer.Option(
+        10, "--concurrency", min=1, help="Maximum submissions scored at once"
+    ),
+    max_group_size: int = typer.Option(
+        1,
+        "--max-group-size",
+        min=1,
+        help="Score up to this many small submissions in one LLM call (1 disables grouping)",
+    ),
+    prime: bool = typer.Option(
+        False,
+        "--prime-prefix",
+        help="Store the rubric prompt on OpenAI once and chain each submission off it",
+    ),
 ):
     validate_paths(assignment_description, rubric_path, submissions_folder)
 
@@ -242,53 +442,63 @@ def main(
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     csv_output_path = Path(f"scores_{timestamp}.csv")
-    initialize_csv(csv_output_path)
+    csv_file = open(csv_output_path, "w", newline="", encoding="utf-8")
+    writer = csv.writer(csv_file)
+    writer.writerow(CSV_FIELDNAMES)
 
-    all_submissions: List[Submission] = []
-    csv_lock = threading.Lock()
-
-    with Progress(*progress_columns, transient=False) as progress:
-        configure_rich_progress_logging(progress.console)
-        logger = logging.getLogger(__name__)
+    csv_queue: "Queue[Submission | None]" = Queue()
+    writer_thread = threading.Thread(
+        target=_writer_loop, args=(csv_queue, writer, csv_file), daemon=True
+    )
+    writer_thread.start()
 
-        task = progress.add_task(
-            "Scoring Submissions",
-            total=len(submission_folders),
-        )
+    all_submissions: List[Submission] = []
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_folder = {
-                executor.submit(
-                    process_single_submission,
-                    submission_folder,
-                    rubric,
-                    assignment_description_content,
-                    csv_output_path,
-                    logger,
-                    csv_lock,
-                ): submission_folder
-                for submission_folder in submission_folders
-            }
-
-            for future in as_completed(future_to_folder):
-                try:
-                    submission = future.result()
-                    all_submissions.append(submission)
-                    append_submission_to_csv(submission, csv_output_path, csv_lock)
-                    progress.update(task, advance=1)
-
-                except Exception as e:
-                    submission_folder = future_to_folder[future]
-                    submission_name = Path(submission_folder).name
-                    failed_submission = create_failed_submission(
-                        submission_folder, submission_name
+    try:
+        # Closing the log handler prints any queued lines before the progress
+        # display stops.
+        with Progress(*progress_columns, transient=False) as progress, closing(
+            configure_rich_progress_logging(progress.console)
+        ):
+            logger = logging.getLogger(__name__)
+
+            task = progress.add_task(
+                "Scoring Submissions",
+                total=len(submission_folders),
+            )
+
+            if batch:
+                all_submissions = asyncio.run(
+                    process_batch(
+                        submission_folders,
+                        rubric,
+                        assignment_description_content,
+                        Path(f"batch_{timestamp}.jsonl"),
+                        csv_queue,
+                        logger,
+                        progress,
+                        task,
                     )
-                    all_submissions.append(failed_submission)
-                    append_submission_to_csv(
-                        failed_submission, csv_output_path, csv_lock
+                )
+            else:
+                all_submissions = asyncio.run(
+                    process_submissions(
+                        submission_folders,
+                        rubric,
+                        assignment_description_content,
+                        csv_queue,
+                        logger,
+                        progress,
+                        task,
+                        concurrency,
+                        max_group_size,
+                        timestamp if prime else None,
                     )
-                    logger.error(f"Error processing {submission_name}: {e}")
-                    progress.update(task, advance=1)
+                )
+    finally:
+        csv_queue.put(None)
+        writer_thread.join()
+        csv_file.close()
 
 
 typer.run(main)
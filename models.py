@@ -10,6 +10,8 @@ class SubmissionFile(BaseModel):
     name: str
     content: str
     path: str
+    # Set instead of content for files listed in the prompt but not sent in full.
+    note: str | None = None
 
 
 class ScoreCriteriaResponse(BaseModel):
@@ -22,6 +24,14 @@ class BatchedScoreResponse(BaseModel):
     overall_feedback: str
 
 
+class GroupedScoreResponse(BatchedScoreResponse):
+    custom_id: str
+
+
+class BatchOfBatchedScoreResponse(BaseModel):
+    submissions: List[GroupedScoreResponse]
+
+
 class CriteriaScore(BaseModel):
     criteria_name: str
     level_definition: str
@@ -40,6 +50,7 @@ class Status(str, Enum):
     SCORING = "scoring"
     SCORED = "scored"
     FAILED = "failed"
+    EMPTY = "empty"
 
 
 class Submission(BaseModel):
@@ -3,13 +3,18 @@ from typing import List
 
 import typer
 import yaml
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, ValidationError, field_validator
 from rich.console import Console
 from rich.panel import Panel
 from rich.table import Table
 
 from utils import format_decimal, print_error
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 class Level(BaseModel):
     definition: str
@@ -20,6 +25,11 @@ class Criteria(BaseModel):
     name: str
     levels: List[Level]
 
+    @field_validator("levels")
+    @classmethod
+    def sort_levels(cls, levels: List[Level]) -> List[Level]:
+        return sorted(levels, key=lambda x: x.score)
+
 
 class Rubric(BaseModel):
     name: str
@@ -29,7 +39,7 @@ class Rubric(BaseModel):
 def load_rubric(rubric_path: Path) -> Rubric:
     try:
         with open(rubric_path, "r") as f:
-            rubric_data = yaml.safe_load(f)
+            rubric_data = yaml.load(f, Loader=SafeLoader)
 
         rubric = Rubric(**rubric_data)
         return rubric
@@ -56,10 +66,8 @@ def print_rubric(rubric: Rubric) -> None:
         table.add_column(overflow="fold")
 
     for criteria in rubric.criteria:
-        sorted_levels = sorted(criteria.levels, key=lambda x: x.score)
-
         row_data = [criteria.name]
-        for level in sorted_levels:
+        for level in criteria.levels:
             level_text = f"{level.definition}\n[bold italic dark_green]{format_decimal(level.score)} points[/bold italic dark_green]"
             row_data.append(level_text)
 
@@ -1,21 +1,27 @@
-from pathlib import Path
+import os
 from typing import List
 
 from utils import print_error
 
+# Moodle names downloaded folders "<full name>_<participant id>_assignsubmission_file_";
+# some unzip tools drop the trailing underscore.
+SUBMISSION_FOLDER_SUFFIXES = ("_assignsubmission_file_", "_assignsubmission_file")
 
-def get_submissions(submissions_folder: str) -> List[str]:
-    submissions_path = Path(submissions_folder)
-    submission_folders: List[str] = []
 
-    if not submissions_path.exists():
+def get_submissions(submissions_folder: str) -> List[str]:
+    if not os.path.exists(submissions_folder):
         print_error(f"Submissions folder '{submissions_folder}' does not exist.")
-        return submission_folders
+        return []
 
-    for folder in submissions_path.iterdir():
-        if folder.is_dir() and "_assignsubmission_file" in folder.name:
-            submission_folders.append(str(folder))
+    # DirEntry.is_dir uses the d_type from readdir, so no extra stat per entry.
+    with os.scandir(submissions_folder) as it:
+        entries = [
+            (entry.name.lower(), entry.path)
+            for entry in it
+            if entry.name.endswith(SUBMISSION_FOLDER_SUFFIXES)
+            and entry.is_dir(follow_symlinks=False)
+        ]
 
-    submission_folders.sort(key=lambda x: Path(x).name.lower())
+    entries.sort()
 
-    return submission_folders
+    return [path for _, path in entries]
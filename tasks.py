@@ -1,75 +1,154 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
 import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Coroutine, Dict, List, Tuple, Type, TypeVar
 
+import httpx
 import openai
+import orjson
+import redis
+from aiolimiter import AsyncLimiter
 from celery import Celery
+from celery.result import AsyncResult
+from celery.signals import worker_process_init
 from dotenv import load_dotenv
-from openai.types.responses import ResponseInputParam
+from kombu.serialization import register
+from openai.lib._parsing._responses import type_to_text_format_param
+from openai.types import Batch
+from openai.types.responses import (Response, ResponseFormatTextConfigParam,
+                                    ResponseInputItemParam, ResponseInputParam)
+from pydantic import BaseModel
+from tenacity import (retry, retry_if_exception_type, stop_after_attempt,
+                      wait_random_exponential)
 
 load_dotenv()
 
-from models import (BatchedScoreResponse, CriteriaScore, Status, Submission,
-                    SubmissionFile)
-from rubric import Criteria
+import cache
+from models import (BatchedScoreResponse, BatchOfBatchedScoreResponse,
+                    CriteriaScore, ScoreCriteriaResponse, Status, Submission,
+                    SubmissionFile, SubmissionScore)
+from rubric import Criteria, Level
 from utils import extract_name
 
 app = Celery(
     "tasks", broker="redis://localhost:6379/0", backend="redis://localhost:6379/0"
 )
 
+# Task arguments and results are plain dicts and lists, so orjson can encode them
+# directly; it is several times faster than the stdlib json used by default.
+register(
+    "orjson",
+    orjson.dumps,
+    orjson.loads,
+    content_type="application/x-orjson",
+    content_encoding="binary",
+)
+app.conf.update(
+    task_serializer="orjson",
+    result_serializer="orjson",
+    accept_content=["orjson", "json"],
+)
 
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+context_client = redis.Redis.from_url("redis://localhost:6379/0")
 
 
-@app.task
-def prepare_submission(
-    folder_path: str,
-) -> Dict[str, Any]:
-    folder_path_obj = Path(folder_path)
-    name = extract_name(folder_path_obj.name)
+def _create_client() -> openai.AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(600.0, connect=10.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    )
+    return openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client
+    )
 
-    try:
-        python_files = list(folder_path_obj.rglob("*.py"))
-
-        submission_files: List[SubmissionFile] = []
-        for file_path in python_files:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read()
-            submission_files.append(
-                SubmissionFile(
-                    name=file_path.name, content=content, path=str(file_path)
-                )
-            )
 
-        submission = Submission(
-            name=name,
-            folder_path=str(folder_path),
-            files=submission_files,
-            status=Status.SCORING,
-        )
+client = _create_client()
 
-        return submission.model_dump()
 
-    except Exception:
-        raise
+@worker_process_init.connect
+def _init_worker_client(**kwargs: Any) -> None:
+    # Prefork children would otherwise share the pool created in the parent;
+    # each worker process gets its own connections instead.
+    global client
+    client = _create_client()
 
 
-@app.task
-def score_submission_batched(
-    criteria_dicts: List[Dict[str, Any]],
-    assignment_description: str,
-    submission_dict: Dict[str, Any],
-) -> Dict[str, Any]:
-    submission = Submission.model_validate(submission_dict)
-    all_criteria = [
-        Criteria.model_validate(criteria_dict) for criteria_dict in criteria_dicts
-    ]
+def _text_format_param(text_format: Type[BaseModel]) -> ResponseFormatTextConfigParam:
+    # The SDK has no public way to build the strict JSON schema that
+    # responses.parse sends, and Batch API lines need the same one. This helper
+    # is private to openai==1.107.3 (pinned in requirements.txt), so recheck it
+    # when upgrading the SDK.
+    return type_to_text_format_param(text_format)
 
-    input_messages: ResponseInputParam = [
-        {
-            "role": "developer",
-            "content": """You are a Computer Science professor scoring a student's assignment for Computer Programming 1 in Python. 
+
+MODEL = "gpt-5-mini"
+
+SCORING_DEADLINE_SECONDS = float(os.getenv("SCORING_DEADLINE_SECONDS", "900"))
+
+# Keeps bursts of scoring calls under the account's per-minute request limit so
+# they queue locally instead of coming back as 429s and piling up retries.
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+
+# Scoring calls a single Celery task keeps in flight for grade_submissions.
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))
+# Jobs at least this large go to the Batch API, which is cheaper but can take hours.
+BULK_SCORE_THRESHOLD = int(os.getenv("BULK_SCORE_THRESHOLD", "50"))
+
+# Long enough to outlive a 24h Batch API job waiting in the queue.
+GRADING_CONTEXT_TTL_SECONDS = 60 * 60 * 24 * 7
+_CONTEXT_PREFIX = "grading_context:"
+
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# The same for every line of a batch file, so the schema is built once.
+BATCH_TEXT_FORMAT = _text_format_param(BatchedScoreResponse)
+
+SUBMISSION_CACHE_DIR = Path(".autograder_cache")
+# Bump when file cleanup changes so stale cached submissions are re-read.
+SUBMISSION_CACHE_VERSION = 7
+
+# Submissions with no code left after cleanup get the lowest level without an LLM
+# call. MIN_SUBMISSION_CHARS optionally treats very short submissions the same
+# way; it is off by default since a correct first-week answer can be one line.
+MIN_SUBMISSION_CHARS = int(os.getenv("MIN_SUBMISSION_CHARS", "0"))
+EMPTY_SUBMISSION_FEEDBACK = "No code submitted"
+
+MAX_BYTES_PER_FILE = int(os.getenv("MAX_BYTES_PER_FILE", str(200 * 1024)))
+EXCLUDED_DIRS = {"__pycache__", "venv", ".venv", "site-packages", ".tox"}
+
+_LEADING_BLANK_LINES_RE = re.compile(r"\A(?:[ \t]*\n)+")
+# Runs of three or more blank lines are squeezed to two, the most PEP 8 uses.
+_BLANK_LINE_RUN_RE = re.compile(r"\n(?:[ \t]*\n){3,}")
+
+T = TypeVar("T")
+ParsedT = TypeVar("ParsedT", bound=BaseModel)
+FileSignature = Tuple[Tuple[str, int, int], ...]
+
+logger = logging.getLogger(__name__)
+
+# Shared by every prepare_submission call, so preparing many submissions at once
+# doesn't start a new pool per submission or multiply the number of open files.
+_read_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="read")
+
+_worker_loop: asyncio.AbstractEventLoop | None = None
+
+_primed_prefix_ids: Dict[Tuple[str, str], str] = {}
+
+_rate_limiter = AsyncLimiter(OPENAI_REQUESTS_PER_MINUTE, 60)
+
+# Part of the score cache scope. Bump whenever the prompt, message layout or
+# response schema changes so scores produced by the old prompt stop being served.
+PROMPT_VERSION = 3
+
+DEVELOPER_PROMPT = """You are a Computer Science professor scoring a student's assignment for Computer Programming 1 in Python. 
 You will be provided with the assignment description, the student's submission, and multiple scoring criteria.
 For each criteria, select the most appropriate level and provide feedback if the student did not meet the criteria.
 Also provide overall feedback on the submission.
@@ -85,22 +164,571 @@ IMPORTANT - Use simple language in all feedback:
 - Avoid being salesy or overly enthusiastic and instead express calm confidence
 - Keep sentences short and clear
 - Avoid using em dashes
+"""
+
+DEVELOPER_MESSAGE: ResponseInputItemParam = {
+    "role": "developer",
+    "content": DEVELOPER_PROMPT,
+}
+
+SCORE_REQUEST_MESSAGE: ResponseInputItemParam = {
+    "role": "user",
+    "content": "Score the submission above using the criteria and instructions given earlier.",
+}
+
+PRIME_MESSAGE: ResponseInputItemParam = {
+    "role": "user",
+    "content": "Reply with OK. Student submissions follow in later messages.",
+}
+
+GROUP_SCORE_REQUEST_MESSAGE: ResponseInputItemParam = {
+    "role": "user",
+    "content": """Score every student above using the criteria and instructions given earlier.
+Return one entry in submissions for every student. Set custom_id to the student number, for example "1" for Student 1.
 """,
-        },
+}
+
+
+def prepare_submission(folder_path: str) -> Submission:
+    root = Path(folder_path)
+    python_files = sorted(
+        p
+        for p in root.rglob("*.py")
+        if EXCLUDED_DIRS.isdisjoint(p.relative_to(root).parts[:-1])
+    )
+
+    signature_entries = []
+    for file_path in python_files:
+        stat = file_path.stat()
+        if stat.st_size > MAX_BYTES_PER_FILE:
+            logger.warning(
+                f"Skipping {file_path}: {stat.st_size} bytes is over the "
+                f"{MAX_BYTES_PER_FILE} byte limit"
+            )
+        signature_entries.append((str(file_path), stat.st_mtime_ns, stat.st_size))
+    signature = tuple(signature_entries)
+
+    submission = _load_submission(str(folder_path), signature)
+
+    # Decided after the cache lookup so changing MIN_SUBMISSION_CHARS applies to
+    # submissions that were read and cached under an older setting.
+    code_chars = sum(len(file.content) for file in submission.files)
+    is_empty = code_chars == 0 or code_chars < MIN_SUBMISSION_CHARS
+    submission.status = Status.EMPTY if is_empty else Status.SCORING
+    return submission
+
+
+def _load_submission(folder_path: str, signature: FileSignature) -> Submission:
+    signature_hash = hashlib.sha256(
+        json.dumps(
+            [SUBMISSION_CACHE_VERSION, MAX_BYTES_PER_FILE, folder_path, signature]
+        ).encode("utf-8")
+    ).hexdigest()
+    cache_path = SUBMISSION_CACHE_DIR / f"{signature_hash}.json"
+
+    try:
+        return Submission.model_validate_json(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        pass
+
+    submission = _read_submission(folder_path, signature)
+
+    try:
+        SUBMISSION_CACHE_DIR.mkdir(exist_ok=True)
+        cache_path.write_text(submission.model_dump_json(), encoding="utf-8")
+    except OSError:
+        pass
+
+    return submission
+
+
+def _read_submission(folder_path: str, signature: FileSignature) -> Submission:
+    name = extract_name(Path(folder_path).name)
+
+    python_files = [Path(path) for path, _, _ in signature]
+    oversized = {path for path, _, size in signature if size > MAX_BYTES_PER_FILE}
+
+    contents = list(
+        _read_executor.map(
+            lambda p: (
+                None
+                if str(p) in oversized
+                else p.read_text(encoding="utf-8", errors="replace")
+            ),
+            python_files,
+        )
+    )
+
+    submission_files: List[SubmissionFile] = []
+    first_names_by_content: Dict[str, str] = {}
+    for file_path, content in zip(python_files, contents):
+        # Files that aren't sent in full are still listed, so the model doesn't
+        # read a required file as missing.
+        if content is None:
+            note = f"skipped: over {MAX_BYTES_PER_FILE} bytes"
+        else:
+            content = _clean_content(content)
+            # Students often submit the same file more than once, e.g. a copy in
+            # a backup folder; it only needs to be scored once.
+            if content in first_names_by_content:
+                note = f"same content as {first_names_by_content[content]}"
+            else:
+                first_names_by_content[content] = file_path.name
+                note = None
+
+        submission_files.append(
+            SubmissionFile(
+                name=file_path.name,
+                content="" if note else content,
+                path=str(file_path),
+                note=note,
+            )
+        )
+
+    return Submission(name=name, folder_path=folder_path, files=submission_files)
+
+
+def _clean_content(content: str) -> str:
+    content = _LEADING_BLANK_LINES_RE.sub("", content).rstrip()
+    return _BLANK_LINE_RUN_RE.sub("\n\n\n", content)
+
+
+async def score_submission_async(
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+    submission: Submission,
+) -> SubmissionScore:
+    scores = await score_batch(
+        all_criteria, criteria_json, assignment_description, [submission]
+    )
+    return scores[0]
+
+
+async def score_batch(
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+    submissions: List[Submission],
+    on_call: Callable[[int, float], None] | None = None,
+) -> List[SubmissionScore]:
+    # criteria_json is dump_criteria(all_criteria), computed once per run by the
+    # caller since every cache and prompt lookup is keyed on it.
+    scope = _score_cache_scope(criteria_json, assignment_description)
+
+    responses: List[BatchedScoreResponse | None] = []
+    misses: List[Tuple[int, str, List[float] | None]] = []
+    for i, submission in enumerate(submissions):
+        if submission.status == Status.EMPTY:
+            responses.append(empty_score_response(all_criteria, submission))
+            continue
+
+        key = cache.cache_key(scope, submission)
+        output_parsed = await cache.get_exact(key)
+        embedding = None
+        # Only pay for an embedding when there is a vector index to search.
+        if output_parsed is None and await cache.semantic_enabled():
+            embedding = await embed_submission(submission)
+            if embedding is not None:
+                output_parsed = await cache.get_similar(
+                    scope, embedding, submission.name
+                )
+
+        responses.append(output_parsed)
+        if output_parsed is None:
+            misses.append((i, key, embedding))
+
+    if misses:
+        start = time.monotonic()
+        scored = await _request_scores(
+            all_criteria,
+            criteria_json,
+            assignment_description,
+            [submissions[i] for i, _, _ in misses],
+        )
+        if on_call:
+            on_call(len(misses), time.monotonic() - start)
+
+        for (i, key, embedding), output_parsed in zip(misses, scored):
+            responses[i] = output_parsed
+            await cache.store(key, scope, output_parsed, embedding)
+
+    return [
+        build_score_result(all_criteria, output_parsed)
+        for output_parsed in responses
+        if output_parsed is not None
+    ]
+
+
+def empty_score_response(
+    all_criteria: List[Criteria], submission: Submission
+) -> BatchedScoreResponse:
+    if any(file.content for file in submission.files):
+        feedback = (
+            f"Submission has less than {MIN_SUBMISSION_CHARS} characters of code, "
+            "so it was not scored"
+        )
+    else:
+        feedback = EMPTY_SUBMISSION_FEEDBACK
+
+    # Levels are sorted by score when the rubric is loaded, so the first is lowest.
+    return BatchedScoreResponse.model_construct(
+        criteria_scores=[
+            ScoreCriteriaResponse.model_construct(
+                selected_level=criteria.levels[0], feedback=feedback
+            )
+            for criteria in all_criteria
+        ],
+        overall_feedback=feedback,
+    )
+
+
+async def get_cached_score(
+    criteria_json: str,
+    assignment_description: str,
+    submission: Submission,
+) -> BatchedScoreResponse | None:
+    scope = _score_cache_scope(criteria_json, assignment_description)
+    return await cache.get_exact(cache.cache_key(scope, submission))
+
+
+async def store_cached_score(
+    criteria_json: str,
+    assignment_description: str,
+    submission: Submission,
+    output_parsed: BatchedScoreResponse,
+) -> None:
+    scope = _score_cache_scope(criteria_json, assignment_description)
+    await cache.store(cache.cache_key(scope, submission), scope, output_parsed)
+
+
+@functools.lru_cache(maxsize=8)
+def _score_cache_scope(criteria_json: str, assignment_description: str) -> str:
+    return cache.cache_scope(
+        MODEL, PROMPT_VERSION, criteria_json, assignment_description
+    )
+
+
+@app.task
+def grade_submission(folder_path: str, context_id: str) -> Dict[str, Any]:
+    submission = prepare_submission(folder_path)
+    all_criteria, criteria_json, assignment_description = _load_grading_context(
+        context_id
+    )
+
+    score = _run_in_worker(
+        score_submission_async(
+            all_criteria, criteria_json, assignment_description, submission
+        )
+    )
+
+    return _score_payload(submission, score)
+
+
+@app.task
+def grade_submissions(folder_paths: List[str], context_id: str) -> List[Dict[str, Any]]:
+    all_criteria, criteria_json, assignment_description = _load_grading_context(
+        context_id
+    )
+
+    return _run_in_worker(
+        _grade_all(folder_paths, all_criteria, criteria_json, assignment_description)
+    )
+
+
+async def _grade_all(
+    folder_paths: List[str],
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+) -> List[Dict[str, Any]]:
+    semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+
+    async def grade(folder_path: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                submission = await asyncio.to_thread(prepare_submission, folder_path)
+                score = await score_submission_async(
+                    all_criteria, criteria_json, assignment_description, submission
+                )
+            except Exception as e:
+                # One bad submission shouldn't fail the rest of the task.
+                return {"folder_path": folder_path, "error": str(e)}
+
+        return _score_payload(submission, score)
+
+    return await asyncio.gather(*(grade(folder_path) for folder_path in folder_paths))
+
+
+@app.task
+def bulk_score(folder_paths: List[str], context_id: str) -> List[Dict[str, Any]]:
+    all_criteria, criteria_json, assignment_description = _load_grading_context(
+        context_id
+    )
+
+    return _run_in_worker(
+        _bulk_score(folder_paths, all_criteria, criteria_json, assignment_description)
+    )
+
+
+def enqueue_grading(
+    folder_paths: List[str],
+    criteria_dicts: List[Dict[str, Any]],
+    assignment_description: str,
+) -> AsyncResult:
+    # Entry point for services that hand grading to a Celery worker fleet; the
+    # CLI in main.py scores in-process and doesn't call it. Large jobs go to one
+    # Batch API task, smaller ones are scored directly by grade_submissions.
+    context_id = store_grading_context(criteria_dicts, assignment_description)
+    task = (
+        bulk_score if len(folder_paths) >= BULK_SCORE_THRESHOLD else grade_submissions
+    )
+    return task.delay(folder_paths, context_id)
+
+
+async def _bulk_score(
+    folder_paths: List[str],
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+) -> List[Dict[str, Any]]:
+    payloads: List[Dict[str, Any] | None] = [None] * len(folder_paths)
+    prepared: List[Tuple[int, Submission]] = []
+
+    for i, folder_path in enumerate(folder_paths):
+        try:
+            prepared.append((i, prepare_submission(folder_path)))
+        except Exception as e:
+            payloads[i] = {"folder_path": folder_path, "error": str(e)}
+
+    results = await score_with_batch_api(
+        all_criteria,
+        criteria_json,
+        assignment_description,
+        [submission for _, submission in prepared],
+    )
+
+    for (i, submission), result in zip(prepared, results):
+        if isinstance(result, BatchedScoreResponse):
+            payloads[i] = _score_payload(
+                submission, build_score_result(all_criteria, result)
+            )
+        else:
+            payloads[i] = {"folder_path": folder_paths[i], "error": str(result)}
+
+    return [payload for payload in payloads if payload is not None]
+
+
+def _score_payload(submission: Submission, score: SubmissionScore) -> Dict[str, Any]:
+    # File contents stay on the worker; the caller only needs the identity.
+    return {
+        "submission": submission.model_dump(exclude={"files"}),
+        "criteria_scores": [
+            criteria_score.model_dump() for criteria_score in score.criteria_scores
+        ],
+        "overall_feedback": score.overall_feedback,
+    }
+
+
+def store_grading_context(
+    criteria_dicts: List[Dict[str, Any]], assignment_description: str
+) -> str:
+    # The rubric and assignment are the same for every task in a job, so they are
+    # stored once and tasks carry only the id. The id is a content hash, so
+    # enqueueing the same job again reuses (and refreshes) the stored copy.
+    # Callers pass plain dicts, so they are validated here (which also sorts the
+    # levels) and workers can rebuild them without validating again.
+    criteria_dicts = [
+        Criteria.model_validate(criteria_dict).model_dump()
+        for criteria_dict in criteria_dicts
+    ]
+    payload = json.dumps(
+        {"criteria": criteria_dicts, "assignment_description": assignment_description},
+        sort_keys=True,
+    )
+    context_id = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    context_client.set(
+        _CONTEXT_PREFIX + context_id, payload, ex=GRADING_CONTEXT_TTL_SECONDS
+    )
+    return context_id
+
+
+@functools.lru_cache(maxsize=8)
+def _load_grading_context(context_id: str) -> Tuple[List[Criteria], str, str]:
+    payload = context_client.get(_CONTEXT_PREFIX + context_id)
+    if payload is None:
+        raise ValueError(f"Grading context {context_id} was not found or has expired")
+
+    context = json.loads(payload)
+    all_criteria = _criteria_from_dicts(context["criteria"])
+    return (
+        all_criteria,
+        dump_criteria(all_criteria),
+        context["assignment_description"],
+    )
+
+
+def _criteria_from_dicts(criteria_dicts: List[Dict[str, Any]]) -> List[Criteria]:
+    # The dicts were validated by store_grading_context before they were stored,
+    # so rebuild the models without validating them again.
+    return [
+        Criteria.model_construct(
+            name=criteria_dict["name"],
+            levels=[
+                Level.model_construct(**level) for level in criteria_dict["levels"]
+            ],
+        )
+        for criteria_dict in criteria_dicts
+    ]
+
+
+def _run_in_worker(coro: Coroutine[Any, Any, T]) -> T:
+    # The async OpenAI and Redis clients bind to the loop that first uses them, so
+    # each worker process keeps one loop alive instead of calling asyncio.run.
+    global _worker_loop
+
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+
+    return _worker_loop.run_until_complete(coro)
+
+
+def build_score_result(
+    all_criteria: List[Criteria], output_parsed: BatchedScoreResponse
+) -> SubmissionScore:
+    criteria_scores: List[CriteriaScore] = []
+    for i, (criteria, score_response) in enumerate(
+        zip(all_criteria, output_parsed.criteria_scores)
+    ):
+        criteria_score = CriteriaScore.model_construct(
+            criteria_name=criteria.name,
+            level_definition=score_response.selected_level.definition,
+            score=score_response.selected_level.score,
+            feedback=score_response.feedback,
+        )
+        criteria_scores.append(criteria_score)
+
+    return SubmissionScore.model_construct(
+        total_score=sum(score.score for score in criteria_scores),
+        criteria_scores=criteria_scores,
+        overall_feedback=output_parsed.overall_feedback,
+    )
+
+
+async def embed_submission(submission: Submission) -> List[float] | None:
+    text = cache.submission_text(submission)
+    if not text or len(text) > cache.MAX_EMBEDDING_CHARS:
+        return None
+
+    try:
+        response = await client.embeddings.create(
+            model=cache.EMBEDDING_MODEL, input=text
+        )
+    except openai.OpenAIError:
+        return None
+
+    return response.data[0].embedding
+
+
+def _build_input_messages(
+    criteria_json: str,
+    assignment_description: str,
+    submission: Submission,
+    include_prefix: bool = True,
+) -> ResponseInputParam:
+    # Everything that varies per student comes after the rubric so the long
+    # shared prefix can hit OpenAI's prompt cache on every request. The student's
+    # name is left out: scores are reused for identical files, so feedback must
+    # not address one student by name.
+    prefix = (
+        _build_static_prefix(criteria_json, assignment_description)
+        if include_prefix
+        else ()
+    )
+
+    return [
+        *prefix,
         {
             "role": "user",
-            "content": f"""Assignment description:
-{assignment_description}
-
-Student: {submission.name}
+            "content": f"""Student submission follows:
 Submitted files: {len(submission.files)}
 """,
         },
+        *_file_messages(submission),
+        SCORE_REQUEST_MESSAGE,
     ]
 
-    for file in submission.files:
+
+def _build_group_input_messages(
+    criteria_json: str,
+    assignment_description: str,
+    submissions: List[Submission],
+    include_prefix: bool = True,
+) -> ResponseInputParam:
+    prefix = (
+        _build_static_prefix(criteria_json, assignment_description)
+        if include_prefix
+        else ()
+    )
+
+    input_messages: ResponseInputParam = [
+        *prefix,
+        {
+            "role": "user",
+            "content": f"""Student submissions follow. You will score {len(submissions)} students. Score each student on their own files only.
+""",
+        },
+    ]
+
+    for i, submission in enumerate(submissions):
         input_messages.append(
             {
+                "role": "user",
+                "content": f"""Student {i + 1} files: {len(submission.files)}""",
+            }
+        )
+        input_messages.extend(_file_messages(submission))
+
+    input_messages.append(GROUP_SCORE_REQUEST_MESSAGE)
+
+    return input_messages
+
+
+def dump_criteria(all_criteria: List[Criteria]) -> str:
+    return json.dumps(
+        [criteria.model_dump() for criteria in all_criteria], sort_keys=True
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _build_static_prefix(
+    criteria_json: str, assignment_description: str
+) -> Tuple[ResponseInputItemParam, ...]:
+    # The rubric and assignment are fixed for a run, so their messages are built
+    # once and shared (read-only) by every request.
+    all_criteria = [
+        Criteria.model_validate(criteria_dict)
+        for criteria_dict in json.loads(criteria_json)
+    ]
+
+    return (
+        DEVELOPER_MESSAGE,
+        {
+            "role": "user",
+            "content": f"""Assignment description:
+{assignment_description}
+""",
+        },
+        {"role": "user", "content": _scoring_instructions(all_criteria)},
+    )
+
+
+def _file_messages(submission: Submission) -> ResponseInputParam:
+    return [
+        (
+            {"role": "user", "content": f"File name: {file.name} ({file.note})"}
+            if file.note
+            else {
                 "role": "user",
                 "content": f"""File name: {file.name}
 ```python
@@ -108,16 +736,16 @@ Submitted files: {len(submission.files)}
 ```""",
             }
         )
+        for file in submission.files
+    ]
 
+
+def _scoring_instructions(all_criteria: List[Criteria]) -> str:
     criteria_info: List[str] = []
     for i, criteria in enumerate(all_criteria):
         levels_text = "\n".join(
-            [
-                f"  * Level {j + 1}: {level.definition} ({level.score} points)"
-                for j, level in enumerate(
-                    sorted(criteria.levels, key=lambda x: x.score)
-                )
-            ]
+            f"  * Level {j + 1}: {level.definition} ({level.score} points)"
+            for j, level in enumerate(criteria.levels)
         )
         criteria_info.append(
             f"""Criteria {i + 1}: {criteria.name}
@@ -125,10 +753,7 @@ Available levels:
 {levels_text}"""
         )
 
-    input_messages.append(
-        {
-            "role": "user",
-            "content": f"""Score ALL of the following criteria based on the student's submission:
+    return f"""Score ALL of the following criteria based on the student's submission:
 
 {chr(10).join(criteria_info)}
 
@@ -139,41 +764,337 @@ For each criteria, please provide:
 Provide overall feedback on the submission in 1-2 encouraging sentences using simple language. Focus on code quality, comments, and readability. Keep sentences short and clear.
 If the student met all criteria, say "Great job!", "Good job!", "Great work!", "Good work!", "Slay!", "Awesome job!", "Awesome work!", "Excellent job!", "Excellent work!" at the beginning of the overall feedback.
 Do not provide feedback that assures the student that they met requirements of the assignment.
-""",
-        }
+"""
+
+
+async def _request_scores(
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+    submissions: List[Submission],
+) -> List[BatchedScoreResponse]:
+    if len(submissions) == 1:
+        return [
+            await _request_score(
+                all_criteria, criteria_json, assignment_description, submissions[0]
+            )
+        ]
+
+    prefix_id = _primed_prefix_ids.get((criteria_json, assignment_description))
+    input_messages = _build_group_input_messages(
+        criteria_json,
+        assignment_description,
+        submissions,
+        include_prefix=prefix_id is None,
     )
 
-    try:
-        response = client.responses.parse(
-            model="gpt-5-mini",
-            input=input_messages,
-            text={"verbosity": "low"},
-            text_format=BatchedScoreResponse,
-            reasoning={"effort": "high"},
-            store=False,
+    output_parsed = await _call_openai(
+        input_messages, BatchOfBatchedScoreResponse, prefix_id
+    )
+
+    by_id = {
+        grouped.custom_id.strip(): grouped for grouped in output_parsed.submissions
+    }
+
+    results: List[BatchedScoreResponse] = []
+    for i, submission in enumerate(submissions):
+        grouped = by_id.get(str(i + 1))
+        if grouped is None or len(grouped.criteria_scores) != len(all_criteria):
+            # The model dropped or mangled this student; score them on their own.
+            results.append(
+                await _request_score(
+                    all_criteria, criteria_json, assignment_description, submission
+                )
+            )
+            continue
+
+        results.append(
+            BatchedScoreResponse.model_construct(
+                criteria_scores=grouped.criteria_scores,
+                overall_feedback=grouped.overall_feedback,
+            )
         )
 
-        if not response or not response.output_parsed:
-            raise ValueError("No response from OpenAI")
+    return results
 
-    except Exception:
-        raise
 
-    output_parsed = response.output_parsed
+async def _request_score(
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+    submission: Submission,
+) -> BatchedScoreResponse:
+    prefix_id = _primed_prefix_ids.get((criteria_json, assignment_description))
+    input_messages = _build_input_messages(
+        criteria_json,
+        assignment_description,
+        submission,
+        include_prefix=prefix_id is None,
+    )
 
-    criteria_scores: List[CriteriaScore] = []
-    for i, (criteria, score_response) in enumerate(
-        zip(all_criteria, output_parsed.criteria_scores)
-    ):
-        criteria_score = CriteriaScore(
-            criteria_name=criteria.name,
-            level_definition=score_response.selected_level.definition,
-            score=score_response.selected_level.score,
-            feedback=score_response.feedback,
+    output_parsed = await _call_openai(input_messages, BatchedScoreResponse, prefix_id)
+    _check_criteria_count(len(all_criteria), output_parsed)
+    return output_parsed
+
+
+def _check_criteria_count(
+    criteria_count: int, output_parsed: BatchedScoreResponse
+) -> None:
+    # build_score_result pairs scores with criteria by position, so a short or
+    # long list would silently drop or misattribute scores.
+    if len(output_parsed.criteria_scores) != criteria_count:
+        raise ValueError(
+            f"OpenAI returned {len(output_parsed.criteria_scores)} criteria scores, "
+            f"expected {criteria_count}"
         )
-        criteria_scores.append(criteria_score)
 
-    return {
-        "criteria_scores": [score.model_dump() for score in criteria_scores],
-        "overall_feedback": output_parsed.overall_feedback,
+
+async def prime_prefix(
+    all_criteria: List[Criteria], assignment_description: str, run_id: str
+) -> str:
+    criteria_json = dump_criteria(all_criteria)
+
+    response = await client.responses.create(
+        model=MODEL,
+        input=[
+            *_build_static_prefix(criteria_json, assignment_description),
+            PRIME_MESSAGE,
+        ],
+        reasoning={"effort": "minimal"},
+        max_output_tokens=64,
+        store=True,
+        metadata={"purpose": "autograder_prefix", "run_id": run_id},
+    )
+
+    # Later requests for this rubric and assignment send only the student's part
+    # and chain off the stored prefix.
+    _primed_prefix_ids[(criteria_json, assignment_description)] = response.id
+    return response.id
+
+
+@retry(
+    retry=retry_if_exception_type(
+        (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+    ),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _call_openai(
+    input_messages: ResponseInputParam,
+    text_format: Type[ParsedT],
+    previous_response_id: str | None = None,
+) -> ParsedT:
+    # Waiting for the limiter doesn't count against the scoring deadline.
+    await _rate_limiter.acquire()
+
+    # Streaming lets a call that runs past the deadline be cut off: leaving the
+    # stream closes the connection, which also stops generation server-side.
+    try:
+        async with asyncio.timeout(SCORING_DEADLINE_SECONDS):
+            # Retries are handled by the decorator, not compounded with the SDK's.
+            async with client.with_options(max_retries=0).responses.stream(
+                model=MODEL,
+                input=input_messages,
+                text={"verbosity": "low"},
+                text_format=text_format,
+                reasoning={"effort": "high"},
+                previous_response_id=previous_response_id or openai.NOT_GIVEN,
+                store=False,
+            ) as stream:
+                response = await stream.get_final_response()
+    except TimeoutError:
+        raise TimeoutError(
+            f"OpenAI did not finish scoring within {SCORING_DEADLINE_SECONDS:g}s"
+        )
+
+    if not response or not response.output_parsed:
+        raise ValueError("No response from OpenAI")
+
+    return response.output_parsed
+
+
+async def score_with_batch_api(
+    all_criteria: List[Criteria],
+    criteria_json: str,
+    assignment_description: str,
+    submissions: List[Submission],
+    batch_file_path: Path | None = None,
+    on_status: Callable[[Batch], None] | None = None,
+) -> List[BatchedScoreResponse | Exception]:
+    results: Dict[str, BatchedScoreResponse | Exception] = {}
+    # Submissions with the same files share the request of the first one.
+    custom_ids: List[str] = []
+    custom_ids_by_hash: Dict[str, str] = {}
+    pending: Dict[str, Submission] = {}
+
+    if batch_file_path is None:
+        fd, batch_file_name = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        upload_path, keep_file = Path(batch_file_name), False
+    else:
+        upload_path, keep_file = batch_file_path, True
+
+    try:
+        with open(upload_path, "w", encoding="utf-8") as batch_file:
+            for i, submission in enumerate(submissions):
+                content_hash = cache.submission_digest(submission)
+                if content_hash in custom_ids_by_hash:
+                    logger.info(
+                        f"{submission.name}: same files as an earlier submission, "
+                        "reusing its score"
+                    )
+                    custom_ids.append(custom_ids_by_hash[content_hash])
+                    continue
+
+                custom_id = str(i)
+                custom_ids_by_hash[content_hash] = custom_id
+                custom_ids.append(custom_id)
+
+                cached = (
+                    empty_score_response(all_criteria, submission)
+                    if submission.status == Status.EMPTY
+                    else await get_cached_score(
+                        criteria_json, assignment_description, submission
+                    )
+                )
+                if cached is not None:
+                    results[custom_id] = cached
+                    continue
+
+                batch_file.write(
+                    build_batch_request(
+                        custom_id, criteria_json, assignment_description, submission
+                    )
+                    + "\n"
+                )
+                pending[custom_id] = submission
+
+        cached_count = len(custom_ids_by_hash) - len(pending)
+        if cached_count:
+            logger.info(
+                f"{cached_count} submissions are cached or empty and were not "
+                "added to the batch"
+            )
+
+        if pending:
+            batch_id = await submit_batch(upload_path)
+            logger.info(f"Submitted batch {batch_id} with {len(pending)} submissions")
+    finally:
+        if not keep_file:
+            os.unlink(upload_path)
+
+    if pending:
+        batch = await wait_for_batch(batch_id, on_status)
+        batch_results = await read_batch_results(batch, len(all_criteria))
+
+        for custom_id, submission in pending.items():
+            result = batch_results.get(custom_id) or ValueError(
+                f"batch {batch.status} without a result"
+            )
+            if isinstance(result, BatchedScoreResponse):
+                await store_cached_score(
+                    criteria_json, assignment_description, submission, result
+                )
+            results[custom_id] = result
+
+    return [results[custom_id] for custom_id in custom_ids]
+
+
+def build_batch_request(
+    custom_id: str,
+    criteria_json: str,
+    assignment_description: str,
+    submission: Submission,
+) -> str:
+    body = {
+        "model": MODEL,
+        "input": _build_input_messages(
+            criteria_json, assignment_description, submission
+        ),
+        "text": {"verbosity": "low", "format": BATCH_TEXT_FORMAT},
+        "reasoning": {"effort": "high"},
+        "store": False,
     }
+
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": body,
+        }
+    )
+
+
+async def submit_batch(batch_file_path: Path) -> str:
+    batch_file = await client.files.create(file=batch_file_path, purpose="batch")
+
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+async def wait_for_batch(
+    batch_id: str,
+    on_status: Callable[[Batch], None] | None = None,
+    initial_delay: float = 5.0,
+    max_delay: float = 300.0,
+) -> Batch:
+    delay = initial_delay
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if on_status:
+            on_status(batch)
+
+        if batch.status in BATCH_TERMINAL_STATUSES:
+            return batch
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+async def read_batch_results(
+    batch: Batch, criteria_count: int
+) -> Dict[str, BatchedScoreResponse | Exception]:
+    results: Dict[str, BatchedScoreResponse | Exception] = {}
+
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+
+        content = (await client.files.content(file_id)).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+
+            result = json.loads(line)
+            try:
+                output_parsed = _parse_batch_result(result)
+                _check_criteria_count(criteria_count, output_parsed)
+                results[result["custom_id"]] = output_parsed
+            except Exception as e:
+                results[result["custom_id"]] = e
+
+    return results
+
+
+def _parse_batch_result(result: Dict[str, Any]) -> BatchedScoreResponse:
+    if result.get("error"):
+        raise ValueError(result["error"].get("message", "Batch request failed"))
+
+    response_data = result["response"]
+    if response_data["status_code"] != 200:
+        error = response_data["body"].get("error") or {}
+        raise ValueError(
+            error.get("message", f"OpenAI returned {response_data['status_code']}")
+        )
+
+    response = Response.model_validate(response_data["body"])
+    if not response.output_text:
+        raise ValueError("No response from OpenAI")
+
+    return BatchedScoreResponse.model_validate_json(response.output_text)
@@ -1,16 +1,24 @@
+import functools
 import logging
 import re
+import threading
+from queue import Full, Queue
 from typing import Optional
 
 from rich.console import Console
 from rich.panel import Panel
 
+_NAME_RE = re.compile(r"_\d+_assignsubmission_file.*$")
+
+_CONSOLE = Console()
+
 
 def extract_name(folder_name: str) -> str:
-    name_part = re.sub(r"_\d+_assignsubmission_file.*$", "", folder_name)
+    name_part = _NAME_RE.sub("", folder_name)
     return name_part.replace("_", " ")
 
 
+@functools.lru_cache(maxsize=1024)
 def format_decimal(value: float) -> str:
     rounded = round(value, 2)
     formatted = f"{rounded:.2f}".rstrip("0").rstrip(".")
@@ -19,8 +27,7 @@ def format_decimal(value: float) -> str:
 
 
 def print_panel(message: str, title: str = "Info", style: str = "blue") -> None:
-    console = Console()
-    console.print(
+    _CONSOLE.print(
         Panel(
             message,
             title=f"[{style}]{title}[/{style}]",
@@ -35,22 +42,43 @@ def print_error(message: str) -> None:
 
 
 class RichConsoleHandler(logging.Handler):
-    def __init__(self, console: Optional[Console] = None):
+    def __init__(self, console: Optional[Console] = None, max_queued: int = 10000):
         super().__init__()
         self.console = console or Console()
+        # Records are printed on a writer thread so logging callers never wait on
+        # the console lock or terminal I/O.
+        self._queue: "Queue[str | None]" = Queue(maxsize=max_queued)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
 
     def emit(self, record: logging.LogRecord) -> None:
         try:
-            message = self.format(record)
-            self.console.print(message)
+            self._queue.put_nowait(self.format(record))
+        except Full:
+            pass
         except Exception:
             self.handleError(record)
 
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        super().close()
+
+    def _write_loop(self) -> None:
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+            self.console.print(message)
+
 
-def configure_rich_progress_logging(console: Console) -> None:
+def configure_rich_progress_logging(console: Console) -> RichConsoleHandler:
     console_handler = RichConsoleHandler(console)
 
     root_logger = logging.getLogger()
     root_logger.handlers.clear()
     root_logger.addHandler(console_handler)
     root_logger.setLevel(logging.INFO)
+
+    return console_handler